@@ -0,0 +1,352 @@
+"""
+Script: fit_sentiment_model.py
+
+Author: Andrew Toner
+
+Purpose: Fit the sentiment v temperature logistic regression from the notebook without loading the tweets into memory.
+            The weather enriched tweet files are streamed in batches and collapsed into counts of tweets and positive
+            tweets for every distinct set of model values (grouped binomial data).  Those counts are all a logistic
+            regression needs so the model is then fitted with Newton-Raphson (IRLS) on the much smaller table.
+            The overall model and a model for every location are built from the same pass over the files.
+
+Command line parameters
+
+--input 100000_tweets_weather.json
+The weather enriched tweet files to use.  Defaults to all the *_tweets_intent_weather.json files in the folder.
+
+--x_col temp
+--x_col average_temp
+The columns used to predict a positive tweet.  Defaults to temp and average_temp like the notebook.
+
+--batch_size 100000
+How many tweets to read in one go.
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import sys
+import tempfile
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+DEFAULT_X_COLS = ['temp', 'average_temp']
+
+
+# Setup Logging
+def setup_logger(log_dir=None,
+                 log_file=None,
+                 log_format=logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"),
+                 log_level=logging.INFO):
+    # Get logger
+    logger = logging.getLogger('')
+    # Clear logger
+    logger.handlers = []
+    # Set level
+    logger.setLevel(log_level)
+    # Setup screen logging (standard out)
+    sh = logging.StreamHandler(sys.stdout)
+    sh.setFormatter(log_format)
+    logger.addHandler(sh)
+    # Setup file logging
+    if log_dir and log_file:
+        fh = logging.FileHandler(os.path.join(log_dir, log_file))
+        fh.setFormatter(log_format)
+        logger.addHandler(fh)
+
+    return logger
+
+
+def list_json_files():
+    """
+    :return: A list of all the weather enriched json files we want to model
+    """
+    result = []
+
+    for file_name in os.listdir("."):
+        if file_name.endswith("_tweets_intent_weather.json"):
+            result.append(file_name)
+
+    return result
+
+
+def is_positive(tweet):
+    """
+    Same rule as the notebook: the winner of Mixed, Positive and Negative (first one wins a tie) has to be Positive.
+    """
+    scores = [tweet['SentimentMixed'], tweet['SentimentPositive'], tweet['SentimentNegative']]
+    return scores.index(max(scores)) == 1
+
+
+def read_batches(file_names, batch_size=100000):
+    """
+    Read the tweet files a batch at a time
+
+    :param file_names: The json line files to read
+    :param batch_size: Maximum number of tweets in a batch
+    :return: generator of lists of tweets
+    """
+    batch = []
+
+    for file_name in file_names:
+        with open(file_name, 'r') as file_read:
+            for line in file_read:
+                batch.append(json.loads(line))
+
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+
+    if batch:
+        yield batch
+
+
+def accumulate_batch(tweets, x_cols, counts):
+    """
+    Add a batch of tweets to the running counts.  Tweets missing any of the model values are dropped, like the
+    dropna() in the notebook.
+
+    :param tweets: List of tweets
+    :param x_cols: The columns used to predict a positive tweet
+    :param counts: Dictionary of (location name, model values) -> [tweet count, positive count] that gets updated
+    :return: Number of tweets used from the batch
+    """
+    sentiment_cols = ['SentimentMixed', 'SentimentPositive', 'SentimentNegative']
+    used = [tweet for tweet in tweets
+            if all(tweet.get(col) is not None for col in x_cols + sentiment_cols + ['location_name'])]
+
+    if not used:
+        return 0
+
+    # Give each location a number so it can sit in the same array as the model values
+    location_names = sorted(set(tweet['location_name'] for tweet in used))
+    location_index = {name: index for index, name in enumerate(location_names)}
+
+    rows = np.array([[location_index[tweet['location_name']]] + [float(tweet[col]) for col in x_cols]
+                     for tweet in used])
+    positive = np.array([is_positive(tweet) for tweet in used], dtype=float)
+
+    unique_rows, inverse = np.unique(rows, axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+    row_counts = np.bincount(inverse, minlength=len(unique_rows))
+    row_positives = np.bincount(inverse, weights=positive, minlength=len(unique_rows))
+
+    for row, total, positives in zip(unique_rows, row_counts, row_positives):
+        key = (location_names[int(row[0])], tuple(row[1:]))
+        entry = counts.setdefault(key, [0, 0])
+        entry[0] += int(total)
+        entry[1] += int(positives)
+
+    return len(used)
+
+
+def fit_logit(x, trials, successes, x_cols, max_iter=35, tol=1e-8):
+    """
+    Fit a logistic regression to grouped binomial data with Newton-Raphson (IRLS).
+    Gives the same answer as statsmodels Logit on the ungrouped data.
+
+    :param x: Array of distinct model values, one row per group
+    :param trials: Number of tweets in each group
+    :param successes: Number of positive tweets in each group
+    :param x_cols: Names of the model columns
+    :param max_iter: Maximum number of Newton steps
+    :param tol: Stop once no coefficient moves more than this
+    :return: Dictionary of the coefficients, standard errors, log likelihood and fit details
+    """
+    params = np.zeros(x.shape[1])
+    hessian = np.eye(x.shape[1])
+    converged = False
+    iterations = 0
+
+    for iterations in range(1, max_iter + 1):
+        probability = 1 / (1 + np.exp(-x.dot(params)))
+        gradient = x.T.dot(successes - trials * probability)
+        weights = trials * probability * (1 - probability)
+        hessian = x.T.dot(x * weights[:, None])
+
+        step = np.linalg.solve(hessian, gradient)
+        params = params + step
+
+        if np.max(np.abs(step)) < tol:
+            converged = True
+            break
+
+    if not converged:
+        log.warning('fit_logit: Did not converge after {} iterations'.format(max_iter))
+
+    linear = x.dot(params)
+    log_likelihood = np.sum(successes * linear - trials * np.logaddexp(0, linear))
+    standard_errors = np.sqrt(np.diag(np.linalg.inv(hessian)))
+
+    return {'params': dict(zip(x_cols, params.tolist())),
+            'bse': dict(zip(x_cols, standard_errors.tolist())),
+            'llf': float(log_likelihood),
+            'nobs': int(np.sum(trials)),
+            'converged': converged,
+            'iterations': iterations}
+
+
+def fit_streaming_logit(file_names, x_cols=None, batch_size=100000, max_iter=35, tol=1e-8):
+    """
+    Stream the tweet files and fit the overall and per location sentiment models in one pass
+
+    :param file_names: The weather enriched json line files
+    :param x_cols: The columns used to predict a positive tweet
+    :param batch_size: How many tweets to read in one go
+    :param max_iter: Maximum number of Newton steps
+    :param tol: Newton convergence tolerance
+    :return: The overall model and a dictionary of location name -> model
+    """
+    if x_cols is None:
+        x_cols = DEFAULT_X_COLS
+
+    counts = {}
+    total = 0
+    used = 0
+
+    for batch in read_batches(file_names, batch_size):
+        total += len(batch)
+        used += accumulate_batch(batch, x_cols, counts)
+        log.debug('fit_streaming_logit: Read {} tweets, {} groups so far'.format(total, len(counts)))
+
+    if not counts:
+        raise ValueError('No usable tweets found in {}'.format(file_names))
+
+    log.info('fit_streaming_logit: Using {} of {} tweets in {} groups'.format(used, total, len(counts)))
+
+    keys = list(counts.keys())
+    locations = np.array([key[0] for key in keys])
+    x = np.array([key[1] for key in keys])
+    trials = np.array([counts[key][0] for key in keys], dtype=float)
+    successes = np.array([counts[key][1] for key in keys], dtype=float)
+
+    model = fit_logit(x, trials, successes, x_cols, max_iter, tol)
+
+    location_models = {}
+    for location in sorted(set(locations)):
+        mask = locations == location
+        try:
+            location_models[location] = fit_logit(x[mask], trials[mask], successes[mask], x_cols, max_iter, tol)
+        except np.linalg.LinAlgError as error:
+            # Not enough different data for this location, keep going so the other models still come back
+            log.warning('fit_streaming_logit: Could not fit {} - {}'.format(location, error))
+            location_models[location] = {'params': {col: float('nan') for col in x_cols},
+                                         'bse': {col: float('nan') for col in x_cols},
+                                         'llf': float('nan'),
+                                         'nobs': int(np.sum(trials[mask])),
+                                         'converged': False,
+                                         'iterations': 0}
+
+    return model, location_models
+
+
+def make_test_tweets(size=2000, seed=0):
+    """
+    Make some fake weather enriched tweets with a known relationship between temperature and sentiment
+    """
+    random = np.random.RandomState(seed)
+    names = ['Seattle', 'New York', 'Manchester', 'Sydney']
+    tweets = []
+
+    for index in range(size):
+        average_temp = [40.1, 31.3, 37.6, 71.8][index % 4]
+        temp = round(average_temp + random.normal(0, 8), 1)
+        positive = random.rand() < 1 / (1 + np.exp(-(0.05 * temp - 0.06 * average_temp)))
+        tweets.append({'id': index, 'location_name': names[index % 4], 'temp': temp, 'average_temp': average_temp,
+                       'SentimentMixed': 0.1, 'SentimentNeutral': 0.2,
+                       'SentimentPositive': 0.6 if positive else 0.1, 'SentimentNegative': 0.1 if positive else 0.6})
+
+    return tweets
+
+
+def test_list_json_files():
+    file_list = list_json_files()
+    assert isinstance(file_list, list), 'Expected a list'
+
+
+def test_is_positive():
+    assert is_positive({'SentimentMixed': 0.1, 'SentimentPositive': 0.5, 'SentimentNegative': 0.2}), 'Positive'
+    assert not is_positive({'SentimentMixed': 0.3, 'SentimentPositive': 0.3, 'SentimentNegative': 0.2}), 'Mixed tie'
+
+
+def test_fit_streaming_logit():
+    tweets = make_test_tweets()
+    tweets.append({'id': -1, 'location_name': 'Seattle', 'average_temp': 40.1,
+                   'SentimentMixed': 0.1, 'SentimentPositive': 0.5, 'SentimentNegative': 0.2})
+    tweets.append({'id': -2, 'location_name': 'Tiny', 'temp': 50.0, 'average_temp': 40.1,
+                   'SentimentMixed': 0.1, 'SentimentPositive': 0.5, 'SentimentNegative': 0.2})
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        file_name = os.path.join(temp_dir, 'test_tweets_intent_weather.json')
+        with open(file_name, 'w') as file_write:
+            for tweet in tweets:
+                file_write.write(json.dumps(tweet) + '\n')
+
+        model, location_models = fit_streaming_logit([file_name], batch_size=333)
+        single_batch_model, _ = fit_streaming_logit([file_name], batch_size=len(tweets))
+
+    assert model['nobs'] == len(tweets) - 1, 'Tweet with no temp should be dropped'
+    assert model['converged'], 'Expected the model to converge'
+    assert sorted(location_models) == ['Manchester', 'New York', 'Seattle', 'Sydney', 'Tiny'], \
+        'Expected a model per location'
+    assert not location_models['Tiny']['converged'], 'One tweet is not enough to fit a model'
+    assert location_models['Tiny']['nobs'] == 1, 'Expected the one Tiny tweet to be counted'
+    assert all(location_models[name]['converged'] for name in ['Manchester', 'New York', 'Seattle', 'Sydney']), \
+        'Other locations should still fit'
+    assert sum(location['nobs'] for location in location_models.values()) == model['nobs'], 'Lost some tweets'
+    for col in DEFAULT_X_COLS:
+        assert abs(model['params'][col] - single_batch_model['params'][col]) < 1e-10, 'Batch size changed the fit'
+
+
+def test_fit_logit_matches_statsmodels():
+    import statsmodels.api as sm
+
+    tweets = make_test_tweets()
+    x = np.array([[tweet['temp'], tweet['average_temp']] for tweet in tweets])
+    y = np.array([is_positive(tweet) for tweet in tweets], dtype=float)
+
+    expected = sm.Logit(y, x).fit(disp=0)
+    model = fit_logit(x, np.ones(len(y)), y, DEFAULT_X_COLS)
+
+    for index, col in enumerate(DEFAULT_X_COLS):
+        assert abs(model['params'][col] - expected.params[index]) < 1e-6, 'Coefficients differ from statsmodels'
+        assert abs(model['bse'][col] - expected.bse[index]) < 1e-6, 'Standard errors differ from statsmodels'
+    assert abs(model['llf'] - expected.llf) < 1e-6, 'Log likelihood differs from statsmodels'
+
+
+if __name__ == "__main__":
+    # Files and folders
+    logging_dir = 'logs'
+    time_date = datetime.datetime.now()
+    string_date = time_date.strftime("%Y%m%d_%H%M%S")
+
+    # Setup Logging
+    logging_level = logging.DEBUG
+    if not os.path.exists(logging_dir):
+        os.makedirs(logging_dir)
+    logging_file = 'fit_sentiment_model_{}.log'.format(string_date)
+    log = setup_logger(logging_dir, logging_file, log_level=logging_level)
+
+    # Grab parameters from the command line
+    parser = argparse.ArgumentParser(description='Fit the sentiment v temperature model a batch at a time.')
+    parser.add_argument('--input', type=str, nargs='*', help='Weather enriched tweet files')
+    parser.add_argument('--x_col', type=str, action='append', help='Column used to predict a positive tweet')
+    parser.add_argument('--batch_size', type=int, default=100000, help='Tweets read in one go')
+    args = parser.parse_args()
+
+    # Perform unit test --> does not return anything and doesn't accept any arguments!
+    test_list_json_files()
+    test_is_positive()
+    test_fit_streaming_logit()
+
+    input_files = args.input if args.input else list_json_files()
+
+    overall_model, per_location_models = fit_streaming_logit(input_files, args.x_col, args.batch_size)
+
+    log.info('All locations: {}'.format(json.dumps(overall_model)))
+    for location_name, location_model in per_location_models.items():
+        log.info('{}: {}'.format(location_name, json.dumps(location_model)))
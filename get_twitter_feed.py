@@ -29,6 +29,8 @@ import sys
 import twitter
 import types
 
+log = logging.getLogger(__name__)
+
 
 # Setup Logging
 def setup_logger(log_dir=None,
@@ -0,0 +1,422 @@
+"""
+Script: get_twitter_feed_sharded.py
+
+Author: Andrew Toner
+
+Purpose: Grab the twitter stream for a set of boundaries using several connections instead of one.
+            The boundary boxes are split across a number of capture processes (shards), each with its own stream and
+            its own set of keys (twitter only allows one filter stream per account).  The supervisor merges what they
+            capture into the same hourly files as get_twitter_feed.py, throws away tweets it has recently seen (by
+            tweet id), and restarts any shard whose stream stops or goes quiet, waiting longer each time it fails.
+
+Command line parameters
+--boundary -122.459696 47.491912 -122.224433 47.734145
+--boundary -74.077185 40.679108 -73.850592 40.839301
+--boundary -2.363539 53.399903 -2.123899 53.554376
+--boundary 150.919615 -34.001366 151.338469 33.733399
+Boundaries that we're interested in from twitter
+
+--shards 2
+Optional.  How many capture processes to split the boundaries across.  Defaults to one per set of keys and can't be
+more than the number of sets of keys.
+
+--consumer_key=[your consumer key]
+--consumer_secret=[your consumer secret]
+--access_token_key=[your access token key]
+--access_token_secret=[your access token secret]
+Keys needed by twitter for authentication.  Only one set, so only one shard.
+
+--credentials_file=[json file]
+Optional.  A json list of {"consumer_key", "consumer_secret", "access_token_key", "access_token_secret"} key sets.
+Each shard uses its own set instead of the keys above.
+
+--recent_ids 100000
+How many recent tweet ids to remember when removing duplicates
+
+--stall_timeout 300
+Restart a shard that hasn't sent anything for this many seconds
+"""
+
+import argparse
+import collections
+import datetime
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import sys
+import tempfile
+import time
+
+from get_twitter_feed import get_tweet_stream, hour_string
+
+log = logging.getLogger(__name__)
+
+
+# Setup Logging
+def setup_logger(log_dir=None,
+                 log_file=None,
+                 log_format=logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"),
+                 log_level=logging.INFO):
+    # Get logger
+    logger = logging.getLogger('')
+    # Clear logger
+    logger.handlers = []
+    # Set level
+    logger.setLevel(log_level)
+    # Setup screen logging (standard out)
+    sh = logging.StreamHandler(sys.stdout)
+    sh.setFormatter(log_format)
+    logger.addHandler(sh)
+    # Setup file logging
+    if log_dir and log_file:
+        fh = logging.FileHandler(os.path.join(log_dir, log_file))
+        fh.setFormatter(log_format)
+        logger.addHandler(fh)
+
+    return logger
+
+
+class RecentIds:
+    """
+    Remembers the last few tweet ids so the memory used doesn't grow forever
+    """
+
+    def __init__(self, limit=100000):
+        self.limit = limit
+        self.order = collections.deque()
+        self.ids = set()
+
+    def add(self, tweet_id):
+        """
+        :return: True if the id is new, False if we've seen it recently
+        """
+        if tweet_id in self.ids:
+            return False
+
+        self.ids.add(tweet_id)
+        self.order.append(tweet_id)
+
+        if len(self.order) > self.limit:
+            self.ids.discard(self.order.popleft())
+
+        return True
+
+
+class HourlyTweetFile:
+    """
+    Writes tweets to a file per hour.  When the hour changes the old file is closed and renamed to .txt
+    ready for scrub_twitter_file.py, the same as get_twitter_feed.py does.
+    """
+
+    def __init__(self, output_dir='.'):
+        self.output_dir = output_dir
+        self.current_hour_string = ''
+        self.filename = ''
+        self.output_file = None
+
+    def write(self, tweet):
+        # Check to see if we're in a new hour.
+        # If so, start a new file
+        if self.current_hour_string != hour_string():
+            log.info('New hour {}'.format(hour_string()))
+
+            # Close current file
+            if self.output_file is not None:
+                log.debug('Closing current output file and renaming')
+                self.output_file.close()
+                os.rename(self.filename, self.filename + '.txt')
+
+            # Open new file
+            self.current_hour_string = hour_string()
+            self.filename = os.path.join(self.output_dir, self.current_hour_string + '_tweets')
+            log.debug('Creating new output file {}'.format(self.filename))
+            self.output_file = open(self.filename, 'a')
+
+        self.output_file.write(tweet + '\n')
+
+    def close(self):
+        # Not renamed as we may be started again in the same hour and carry on appending to it
+        if self.output_file is not None:
+            self.output_file.close()
+            self.output_file = None
+
+
+def partition_boundaries(boundaries, shards):
+    """
+    Deal the boundary boxes out to the shards like cards so each gets a similar number
+
+    :param boundaries: List of [long, lat, long, lat] boxes
+    :param shards: How many shards we want
+    :return: List of boundary lists, one per shard.  Never more shards than boxes.
+    """
+    shards = max(1, min(shards, len(boundaries)))
+
+    return [boundaries[shard::shards] for shard in range(shards)]
+
+
+def capture_shard(shard, boundaries, credentials, stream_factory, tweet_queue):
+    """
+    Run in a child process.  Read one stream for some boundaries and pass everything to the supervisor.
+    Returns when the stream stops so the supervisor can start it again.
+
+    :param shard: Shard number, sent with every tweet so the supervisor knows the shard is still alive
+    :param boundaries: The boundary boxes for this shard
+    :param credentials: Dictionary of twitter keys
+    :param stream_factory: Function like get_tweet_stream that gives a generator of tweet json strings
+    :param tweet_queue: Where to put (shard, tweet id, tweet json) tuples
+    """
+    flatten_boundaries = [str(coord) for boundary in boundaries for coord in boundary]
+
+    for tweet in stream_factory(boundaries=flatten_boundaries, **credentials):
+        # Limit notices don't have an id, they're passed on without de-duplicating
+        tweet_queue.put((shard, json.loads(tweet).get('id'), tweet))
+
+    log.warning('capture_shard: Stream for shard {} stopped'.format(shard))
+
+
+def backoff_delay(failures, restart_delay, max_restart_delay):
+    """
+    How long to wait before restarting a shard.  Doubles with every failure in a row so a shard that keeps failing
+    doesn't hammer twitter.
+
+    :param failures: Number of times in a row the shard has failed, counting this one
+    :param restart_delay: Seconds to wait after the first failure
+    :param max_restart_delay: Never wait longer than this
+    :return: Seconds to wait
+    """
+    return min(restart_delay * 2 ** (failures - 1), max_restart_delay)
+
+
+def run_supervisor(boundaries, credentials, shards=2, stream_factory=get_tweet_stream, output_dir='.',
+                   recent_id_limit=100000, restart_delay=5, max_restart_delay=900, stall_timeout=300,
+                   run_seconds=None):
+    """
+    Start the capture shards, merge and de-duplicate what they send into hourly files, and restart shards that stop
+    or go quiet.
+
+    Twitter only allows one filter stream per account, so every shard needs its own set of keys.
+
+    :param boundaries: List of [long, lat, long, lat] boxes
+    :param credentials: List of dictionaries of twitter keys, one per shard
+    :param shards: How many capture processes to run
+    :param stream_factory: Function like get_tweet_stream, swap it for a fake one when testing
+    :param output_dir: Where to put the hourly files
+    :param recent_id_limit: How many recent tweet ids to remember
+    :param restart_delay: Seconds to wait before restarting a stopped shard, doubled for every failure in a row
+    :param max_restart_delay: Longest wait before restarting a shard
+    :param stall_timeout: Restart a shard that has sent nothing for this many seconds
+    :param run_seconds: Stop after this many seconds, or run forever if None
+    :return: Dictionary of counts of tweets received, written, duplicates, restarts and stalls
+    """
+    shard_boundaries = partition_boundaries(boundaries, shards)
+
+    if len(shard_boundaries) > len(credentials):
+        raise ValueError('{} shards need {} sets of twitter keys, only got {}'.format(
+            len(shard_boundaries), len(shard_boundaries), len(credentials)))
+
+    tweet_queue = multiprocessing.Queue(maxsize=10000)
+    processes = {}
+    restart_times = {}
+    last_message_times = {}
+    failures = {}
+    recent_ids = RecentIds(recent_id_limit)
+    output = HourlyTweetFile(output_dir)
+    stats = {'received': 0, 'written': 0, 'duplicates': 0, 'restarts': 0, 'stalls': 0}
+
+    def start_shard(shard):
+        process = multiprocessing.Process(target=capture_shard,
+                                          args=(shard, shard_boundaries[shard], credentials[shard],
+                                                stream_factory, tweet_queue),
+                                          daemon=True)
+        process.start()
+        processes[shard] = process
+        last_message_times[shard] = time.time()
+        log.info('run_supervisor: Started shard {} for {}'.format(shard, shard_boundaries[shard]))
+
+    for shard in range(len(shard_boundaries)):
+        failures[shard] = 0
+        start_shard(shard)
+
+    end_time = None if run_seconds is None else time.time() + run_seconds
+
+    try:
+        while end_time is None or time.time() < end_time:
+            for shard, process in processes.items():
+                # A hung connection keeps the process alive, so stop any shard that has gone quiet
+                if process.is_alive():
+                    if time.time() - last_message_times[shard] > stall_timeout:
+                        log.warning('run_supervisor: Shard {} sent nothing for {} seconds, stopping it'.format(
+                            shard, stall_timeout))
+                        stats['stalls'] += 1
+                        process.terminate()
+                        process.join()
+                    else:
+                        continue
+
+                # Restart any shard that has stopped, once it's had a rest
+                if shard not in restart_times:
+                    failures[shard] += 1
+                    delay = backoff_delay(failures[shard], restart_delay, max_restart_delay)
+                    log.warning('run_supervisor: Shard {} stopped with exit code {}, restarting in {} seconds'.format(
+                        shard, process.exitcode, delay))
+                    restart_times[shard] = time.time() + delay
+                elif time.time() >= restart_times[shard]:
+                    del restart_times[shard]
+                    stats['restarts'] += 1
+                    start_shard(shard)
+
+            try:
+                shard, tweet_id, tweet = tweet_queue.get(timeout=1)
+            except queue.Empty:
+                continue
+
+            stats['received'] += 1
+            last_message_times[shard] = time.time()
+            failures[shard] = 0
+
+            if tweet_id is not None and not recent_ids.add(tweet_id):
+                stats['duplicates'] += 1
+                continue
+
+            output.write(tweet)
+            stats['written'] += 1
+
+    finally:
+        for process in processes.values():
+            process.terminate()
+        output.close()
+        log.info('run_supervisor: {}'.format(stats))
+
+    return stats
+
+
+def fake_tweet_stream(boundaries=[], **credentials):
+    """
+    Stands in for get_tweet_stream when testing.  Every shard sends the same few tweets then stops.
+    """
+    for tweet_id in range(20):
+        yield json.dumps({'id': tweet_id, 'text': 'Tweet from {}'.format(boundaries[:2])})
+
+
+def fake_hung_stream(boundaries=[], **credentials):
+    """
+    Stands in for get_tweet_stream when testing.  Sends a tweet then hangs like a dead connection.
+    """
+    yield json.dumps({'id': 1, 'text': 'Tweet from {}'.format(boundaries[:2])})
+    time.sleep(3600)
+
+
+def test_partition_boundaries():
+    boundaries = [[1, 1, 2, 2], [3, 3, 4, 4], [5, 5, 6, 6]]
+    assert partition_boundaries(boundaries, 2) == [[[1, 1, 2, 2], [5, 5, 6, 6]], [[3, 3, 4, 4]]], 'Wrong split'
+    assert len(partition_boundaries(boundaries, 5)) == 3, 'Should not have more shards than boxes'
+
+
+def test_recent_ids():
+    recent_ids = RecentIds(2)
+    assert recent_ids.add(1), 'New id'
+    assert not recent_ids.add(1), 'Seen id'
+    recent_ids.add(2)
+    recent_ids.add(3)
+    assert recent_ids.add(1), 'Forgotten id should be new again'
+    assert len(recent_ids.ids) == 2, 'Remembering too many ids'
+
+
+def test_backoff_delay():
+    assert backoff_delay(1, 5, 900) == 5, 'First restart should wait restart_delay'
+    assert backoff_delay(3, 5, 900) == 20, 'Expected the wait to double for every failure'
+    assert backoff_delay(20, 5, 900) == 900, 'Should never wait longer than max_restart_delay'
+
+
+def test_run_supervisor():
+    boundaries = [[1, 1, 2, 2], [3, 3, 4, 4]]
+
+    try:
+        run_supervisor(boundaries, [{}], shards=2, stream_factory=fake_tweet_stream)
+        assert False, 'Two shards sharing one set of keys should not start'
+    except ValueError:
+        pass
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        stats = run_supervisor(boundaries, [{}, {}], shards=2, stream_factory=fake_tweet_stream, output_dir=temp_dir,
+                               restart_delay=0.1, run_seconds=3)
+
+        ids = []
+        for file_name in os.listdir(temp_dir):
+            with open(os.path.join(temp_dir, file_name), 'r') as file_read:
+                ids.extend(json.loads(line)['id'] for line in file_read)
+
+    assert sorted(ids) == list(range(20)), 'Expected every tweet once'
+    assert stats['duplicates'] > 0, 'Expected duplicates across shards'
+    assert stats['restarts'] > 0, 'Expected stopped shards to be restarted'
+
+
+def test_run_supervisor_stall():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        stats = run_supervisor([[1, 1, 2, 2]], [{}], shards=1, stream_factory=fake_hung_stream, output_dir=temp_dir,
+                               restart_delay=0.1, stall_timeout=0.5, run_seconds=3)
+
+    assert stats['stalls'] > 0, 'Expected the hung shard to be noticed'
+    assert stats['restarts'] > 0, 'Expected the hung shard to be restarted'
+    assert stats['written'] == 1, 'Expected the repeated tweet to be written once'
+
+
+if __name__ == "__main__":
+    # Files and folders
+    logging_dir = 'logs'
+    time_date = datetime.datetime.now()
+    string_date = time_date.strftime("%Y%m%d_%H%M%S")
+
+    # Setup Logging
+    logging_level = logging.DEBUG
+    if not os.path.exists(logging_dir):
+        os.makedirs(logging_dir)
+    logging_file = 'get_twitter_feed_sharded_{}.log'.format(string_date)
+    log = setup_logger(logging_dir, logging_file, log_level=logging_level)
+
+    # Grab parameters from the command line
+    parser = argparse.ArgumentParser(description='Read a lot of tweets into some files using several connections.')
+    parser.add_argument('--consumer_key', type=str, help='Twitter app consumer key')
+    parser.add_argument('--consumer_secret', type=str, help='Twitter app consumer key secret')
+    parser.add_argument('--access_token_key', type=str, help='Twitter app access token key')
+    parser.add_argument('--access_token_secret', type=str, help='Twitter app access token secret')
+    parser.add_argument('--credentials_file', type=str, help='Json list of twitter key sets, one per shard')
+    parser.add_argument('--boundary', nargs=4, type=float, action='append', help='Area boundary', required=True)
+    parser.add_argument('--shards', type=int, help='Number of capture processes, defaults to one per set of keys')
+    parser.add_argument('--recent_ids', type=int, default=100000, help='Recent tweet ids remembered for de-duplicating')
+    parser.add_argument('--stall_timeout', type=float, default=300, help='Restart a shard quiet for this many seconds')
+    args = parser.parse_args()
+
+    if args.credentials_file:
+        with open(args.credentials_file, 'r') as credentials_read:
+            credential_sets = json.load(credentials_read)
+    elif args.consumer_key and args.consumer_secret and args.access_token_key and args.access_token_secret:
+        credential_sets = [{'consumer_key': args.consumer_key,
+                            'consumer_secret': args.consumer_secret,
+                            'access_token_key': args.access_token_key,
+                            'access_token_secret': args.access_token_secret}]
+    else:
+        parser.error('Need either --credentials_file or all four twitter keys')
+
+    if not credential_sets:
+        parser.error('No twitter keys found in {}'.format(args.credentials_file))
+
+    if args.shards is None:
+        args.shards = len(credential_sets)
+
+    if min(args.shards, len(args.boundary)) > len(credential_sets):
+        parser.error('Twitter allows one stream per set of keys, {} shards but only {} sets of keys'.format(
+            args.shards, len(credential_sets)))
+
+    # Perform unit test --> does not return anything and doesn't accept any arguments!
+    test_partition_boundaries()
+    test_recent_ids()
+    test_backoff_delay()
+    test_run_supervisor()
+    test_run_supervisor_stall()
+
+    # We'll sit and read the twitter streams for ever
+    run_supervisor(args.boundary, credential_sets, shards=args.shards, recent_id_limit=args.recent_ids,
+                   stall_timeout=args.stall_timeout)
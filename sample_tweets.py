@@ -0,0 +1,414 @@
+"""
+Script: sample_tweets.py
+
+Author: Andrew Toner
+
+Purpose: Make analysis subsets of a tweet json file without hand made copies of the whole thing.
+            A line offset index (uint64 byte offsets plus the location and hour of every tweet) is built once and saved
+            next to the file.  Uniform or stratified samples are then read straight from the file through the index.
+            Reservoir sampling picks a sample in a single pass when there's no index.
+
+Example command line
+
+--input 2336596_tweets_weather.json
+The tweet json file to sample.
+
+--size 200000
+How many tweets we want.
+
+--stratify location_name
+Optional.  Sample the same share of every location_name or hour as the full file.
+
+--reservoir
+Optional.  Skip the index and pick the sample with a single pass over the file.
+
+--output 200000_tweets_weather.json
+Optional.  Where to put the sample.  Defaults to [input file name]_[size]_sample.json so the other scripts, which
+look for files ending in _tweets.json, _tweets_intent.json or _tweets_intent_weather.json, don't pick it up.
+
+--seed 42
+Optional.  Random seed so a sample can be made again.
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import math
+import os
+import sys
+import tempfile
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+STRATA = ['location_name', 'hour']
+
+
+# Setup Logging
+def setup_logger(log_dir=None,
+                 log_file=None,
+                 log_format=logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"),
+                 log_level=logging.INFO):
+    # Get logger
+    logger = logging.getLogger('')
+    # Clear logger
+    logger.handlers = []
+    # Set level
+    logger.setLevel(log_level)
+    # Setup screen logging (standard out)
+    sh = logging.StreamHandler(sys.stdout)
+    sh.setFormatter(log_format)
+    logger.addHandler(sh)
+    # Setup file logging
+    if log_dir and log_file:
+        fh = logging.FileHandler(os.path.join(log_dir, log_file))
+        fh.setFormatter(log_format)
+        logger.addHandler(fh)
+
+    return logger
+
+
+def index_file_name(file_name):
+    """
+    :return: Where the line index for a tweet file lives
+    """
+    return file_name + '.idx.npz'
+
+
+def tweet_hour(tweet):
+    """
+    Get the UTC hour of a tweet from the 'Tue Jan 23 03:00:33 +0000 2018' style time.
+    Raw twitter files call it created_at, the scrubbed files call it time.
+    :return: The hour or -1 if we can't tell
+    """
+    time = tweet.get('time') or tweet.get('created_at')
+
+    if not time:
+        return -1
+
+    return datetime.datetime.strptime(time, '%a %b %d %H:%M:%S %z %Y').hour
+
+
+def build_line_index(file_name):
+    """
+    Read the file once and save the byte offset, location and hour of every line
+
+    :param file_name: The json line file to index
+    :return: Dictionary of offsets, location_codes, location_names, hours and the file_size, file_mtime and file_inode
+                used to spot when the file has changed
+    """
+    # Taken before reading so a change while we're indexing makes the index look stale
+    file_stat = os.stat(file_name)
+    offsets = []
+    location_codes = []
+    hours = []
+    location_names = {}
+
+    with open(file_name, 'rb') as file_read:
+        offset = 0
+        for line in file_read:
+            if line.strip():
+                tweet = json.loads(line)
+                location_name = tweet.get('location_name', '')
+
+                offsets.append(offset)
+                location_codes.append(location_names.setdefault(location_name, len(location_names)))
+                hours.append(tweet_hour(tweet))
+
+            offset += len(line)
+
+    index = {'offsets': np.array(offsets, dtype=np.uint64),
+             'location_codes': np.array(location_codes, dtype=np.uint16),
+             'location_names': np.array(sorted(location_names, key=location_names.get), dtype=str),
+             'hours': np.array(hours, dtype=np.int8),
+             'file_size': np.array(offset, dtype=np.uint64),
+             'file_mtime': np.array(file_stat.st_mtime_ns, dtype=np.int64),
+             'file_inode': np.array(file_stat.st_ino, dtype=np.uint64)}
+
+    np.savez(index_file_name(file_name), **index)
+    log.info('build_line_index: {} lines indexed in {}'.format(len(offsets), index_file_name(file_name)))
+
+    return index
+
+
+def index_is_current(index, file_name):
+    """
+    :return: True if the file still has the size, modified time and inode it had when the index was built
+    """
+    if not all(key in index for key in ['file_size', 'file_mtime', 'file_inode']):
+        return False
+
+    file_stat = os.stat(file_name)
+
+    return (int(index['file_size']) == file_stat.st_size and
+            int(index['file_mtime']) == file_stat.st_mtime_ns and
+            int(index['file_inode']) == file_stat.st_ino)
+
+
+def load_line_index(file_name):
+    """
+    Load the line index for a file, building it if it's missing or the file has changed since
+    """
+    if os.path.exists(index_file_name(file_name)):
+        with np.load(index_file_name(file_name)) as saved:
+            index = {key: saved[key] for key in saved.files}
+
+        if index_is_current(index, file_name):
+            return index
+
+        log.info('load_line_index: {} has changed, rebuilding the index'.format(file_name))
+
+    return build_line_index(file_name)
+
+
+def read_lines(file_name, offsets):
+    """
+    Read the lines that start at the given byte offsets.  They're read in file order to keep the disk happy.
+
+    :return: generator of lines
+    """
+    with open(file_name, 'rb') as file_read:
+        for offset in np.sort(offsets):
+            file_read.seek(int(offset))
+            yield file_read.readline().decode('utf-8').rstrip('\n')
+
+
+def stratum_labels(index, stratify):
+    """
+    :return: Array with the stratum of every line in the index
+    """
+    if stratify == 'location_name':
+        return index['location_codes']
+    elif stratify == 'hour':
+        return index['hours']
+
+    raise ValueError('Can only stratify by {}, not {}'.format(STRATA, stratify))
+
+
+def sample_line_numbers(index, size, stratify=None, seed=None):
+    """
+    Pick line numbers without replacement, either uniformly or with every stratum keeping its share of the file.
+    Stratum sizes are rounded with the largest remainder method so they add up to size.
+
+    :param index: A line index from load_line_index
+    :param size: How many lines we want
+    :param stratify: None, location_name or hour
+    :param seed: Random seed
+    :return: Sorted array of line numbers
+    """
+    random = np.random.RandomState(seed)
+    line_count = len(index['offsets'])
+    size = min(size, line_count)
+
+    if stratify is None:
+        return np.sort(random.choice(line_count, size, replace=False))
+
+    labels = stratum_labels(index, stratify)
+    strata, stratum_counts = np.unique(labels, return_counts=True)
+
+    quotas = stratum_counts * size / line_count
+    stratum_sizes = np.floor(quotas).astype(int)
+    shortfall = size - stratum_sizes.sum()
+    stratum_sizes[np.argsort(stratum_sizes - quotas)[:shortfall]] += 1
+
+    result = []
+    for stratum, stratum_size in zip(strata, stratum_sizes):
+        members = np.flatnonzero(labels == stratum)
+        result.append(random.choice(members, stratum_size, replace=False))
+
+    return np.sort(np.concatenate(result))
+
+
+def reservoir_sample(file_name, size, seed=None):
+    """
+    Pick a uniform sample of lines in a single pass over the file.
+    Uses Algorithm L (Li 1994) which jumps over the lines it won't keep rather than rolling for every line.
+
+    :param file_name: The json line file to sample
+    :param size: How many lines we want
+    :param seed: Random seed
+    :return: List of lines in the order they appear in the file
+    """
+    if size <= 0:
+        return []
+
+    random = np.random.RandomState(seed)
+    reservoir = []
+    positions = []
+
+    with open(file_name, 'r') as file_read:
+        lines = (line.rstrip('\n') for line in file_read if line.strip())
+
+        for position, line in enumerate(lines):
+            reservoir.append(line)
+            positions.append(position)
+            if len(reservoir) == size:
+                break
+        else:
+            return reservoir
+
+        weight = math.exp(math.log(random.rand()) / size)
+        position = size - 1
+        while True:
+            skip = int(math.floor(math.log(random.rand()) / math.log(1 - weight)))
+
+            line = None
+            for line in lines:
+                position += 1
+                if skip == 0:
+                    break
+                skip -= 1
+            else:
+                break
+
+            replace = random.randint(size)
+            reservoir[replace] = line
+            positions[replace] = position
+            weight *= math.exp(math.log(random.rand()) / size)
+
+    return [line for _, line in sorted(zip(positions, reservoir))]
+
+
+def write_sample(lines, output_filename):
+    """
+    Write the sampled lines out as a json line file
+    :return: Number of lines written
+    """
+    written = 0
+
+    with open(output_filename, 'w') as file_write:
+        for line in lines:
+            file_write.write(line + '\n')
+            written += 1
+
+    return written
+
+
+def make_test_file(directory, size=1000):
+    """
+    Make a small fake tweet file to sample from
+    """
+    names = ['Seattle', 'New York', 'Manchester', 'Sydney']
+    file_name = os.path.join(directory, 'test_tweets_weather.json')
+
+    with open(file_name, 'w') as file_write:
+        for index in range(size):
+            # Seattle gets half of all the tweets
+            name = names[0] if index % 2 else names[index % 3 + 1]
+            tweet = {'id': index, 'time': 'Tue Jan 23 {:02}:00:33 +0000 2018'.format(index % 24),
+                     'location_name': name, 'text': 'Tweet {} ☃'.format(index)}
+            file_write.write(json.dumps(tweet) + '\n')
+
+    return file_name
+
+
+def test_tweet_hour():
+    assert tweet_hour({'time': 'Tue Jan 23 03:00:33 +0000 2018'}) == 3, 'Wrong hour'
+    assert tweet_hour({}) == -1, 'Expected -1 for no time'
+
+
+def test_build_line_index():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        file_name = make_test_file(temp_dir)
+        index = load_line_index(file_name)
+
+        assert index['offsets'].dtype == np.uint64, 'Expected uint64 offsets'
+        assert len(index['offsets']) == 1000, 'Expected a line per tweet'
+
+        lines = list(read_lines(file_name, index['offsets'][[999, 10]]))
+        assert [json.loads(line)['id'] for line in lines] == [10, 999], 'Read the wrong lines'
+
+        reloaded = load_line_index(file_name)
+        assert np.array_equal(reloaded['offsets'], index['offsets']), 'Saved index differs'
+
+        # Same number of bytes but the lines are in a different order
+        with open(file_name, 'r') as file_read:
+            lines = file_read.readlines()
+        with open(file_name, 'w') as file_write:
+            file_write.writelines(lines[::-1])
+        file_stat = os.stat(file_name)
+        os.utime(file_name, ns=(file_stat.st_atime_ns, file_stat.st_mtime_ns + 1000000000))
+
+        rewritten = load_line_index(file_name)
+        first_line = next(read_lines(file_name, rewritten['offsets'][:1]))
+        assert json.loads(first_line)['id'] == 999, 'Rewritten file should be indexed again'
+
+
+def test_sample_line_numbers():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        index = load_line_index(make_test_file(temp_dir))
+
+    uniform = sample_line_numbers(index, 100, seed=1)
+    assert len(np.unique(uniform)) == 100, 'Expected 100 different lines'
+
+    stratified = sample_line_numbers(index, 100, stratify='location_name', seed=1)
+    seattle = index['location_names'].tolist().index('Seattle')
+    assert len(np.unique(stratified)) == 100, 'Expected 100 different lines'
+    assert np.sum(index['location_codes'][stratified] == seattle) == 50, 'Seattle should be half the sample'
+
+    by_hour = sample_line_numbers(index, 240, stratify='hour', seed=1)
+    assert np.all(np.bincount(index['hours'][by_hour]) == 10), 'Expected 10 tweets an hour'
+
+
+def test_reservoir_sample():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        file_name = make_test_file(temp_dir)
+        sample = reservoir_sample(file_name, 100, seed=1)
+        everything = reservoir_sample(file_name, 2000, seed=1)
+        nothing = reservoir_sample(file_name, 0, seed=1)
+
+    ids = [json.loads(line)['id'] for line in sample]
+    assert len(set(ids)) == 100, 'Expected 100 different tweets'
+    assert ids == sorted(ids), 'Expected the sample in file order'
+    assert len(everything) == 1000, 'Asking for more than there is should get the whole file'
+    assert nothing == [], 'Asking for nothing should get nothing'
+
+
+if __name__ == "__main__":
+    # Files and folders
+    logging_dir = 'logs'
+    time_date = datetime.datetime.now()
+    string_date = time_date.strftime("%Y%m%d_%H%M%S")
+
+    # Setup Logging
+    logging_level = logging.DEBUG
+    if not os.path.exists(logging_dir):
+        os.makedirs(logging_dir)
+    logging_file = 'sample_tweets_{}.log'.format(string_date)
+    log = setup_logger(logging_dir, logging_file, log_level=logging_level)
+
+    # Grab parameters from the command line
+    parser = argparse.ArgumentParser(description='Make a sample of a tweet file.')
+    parser.add_argument('--input', type=str, help='Tweet json file to sample', required=True)
+    parser.add_argument('--size', type=int, help='Number of tweets to sample', required=True)
+    parser.add_argument('--stratify', type=str, choices=STRATA, help='Keep the share of each location or hour')
+    parser.add_argument('--reservoir', action='store_true', help='Single pass sample without the index')
+    parser.add_argument('--output', type=str, help='Sample file name')
+    parser.add_argument('--seed', type=int, help='Random seed')
+    args = parser.parse_args()
+
+    if args.size <= 0:
+        parser.error('--size has to be more than 0')
+
+    # Perform unit test --> does not return anything and doesn't accept any arguments!
+    test_tweet_hour()
+    test_build_line_index()
+    test_sample_line_numbers()
+    test_reservoir_sample()
+
+    output_filename = args.output
+    if output_filename is None:
+        output_filename = '{}_{}_sample.json'.format(os.path.splitext(os.path.basename(args.input))[0], args.size)
+
+    if args.reservoir:
+        if args.stratify is not None:
+            parser.error('--stratify needs the index so it can not be used with --reservoir')
+        sampled_lines = reservoir_sample(args.input, args.size, args.seed)
+    else:
+        line_index = load_line_index(args.input)
+        line_numbers = sample_line_numbers(line_index, args.size, args.stratify, args.seed)
+        sampled_lines = read_lines(args.input, line_index['offsets'][line_numbers])
+
+    log.info('{} - Wrote {} tweets'.format(output_filename, write_sample(sampled_lines, output_filename)))